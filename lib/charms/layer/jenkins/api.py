@@ -102,6 +102,20 @@ class Api(object):
             return False
         return version
 
+    def get_plugin_versions(self):
+        """Get the installed versions of all plugins in a single call
+
+        Returns a dict mapping plugin short names to versions.
+        """
+        client = self._make_client()
+        script = 'Jenkins.instance.pluginManager.plugins.each{println("${it.shortName}=${it.version}")}'
+        versions = {}
+        for line in client.run_script(script).splitlines():
+            name, _, version = line.strip().partition("=")
+            if name:
+                versions[name] = version
+        return versions
+
     def configure_proxy(self, hostname=None, port=None, username=None, password=None):
         """Configure (or disable) a system proxy."""
         client = self._make_client()
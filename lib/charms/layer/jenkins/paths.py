@@ -19,3 +19,5 @@ INITIAL_PASSWORD = os.path.join(SECRETS, "initialAdminPassword")
 LAST_EXEC = os.path.join(HOME, "jenkins.install.InstallUtil.lastExecVersion")
 LEGACY_BOOTSTRAP_FLAG = os.path.join(HOME, "config.bootstrapped")
 UPDATE_CENTER_ROOT_CAS = os.path.join(HOME, "update-center-rootCAs")
+PLUGIN_RESOLVE_CACHE = os.path.join(HOME, ".plugin-resolve-cache.json")
+PLUGINS_FINGERPRINT = os.path.join(HOME, ".charm-plugins-fingerprint")
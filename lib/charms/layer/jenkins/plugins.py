@@ -1,8 +1,13 @@
-import glob
+import grp
+import hashlib
+import json
 import os
+import pwd
 import shutil
+import socket
 import urllib
-from distutils.dir_util import copy_tree, remove_tree
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote, urlunparse
 
 from charmhelpers.core import hookenv, host
 from charms.layer.jenkins import paths
@@ -10,6 +15,39 @@ from charms.layer.jenkins.api import Api
 
 from jenkins_plugin_manager.plugin import UpdateCenter
 
+# Precomputed templates for plugin archive paths under paths.PLUGINS.
+PLUGIN_FILE_TEMPLATE = os.path.join(paths.PLUGINS, "{}.jpi")
+PLUGIN_HPI_TEMPLATE = os.path.join(paths.PLUGINS, "{}.hpi")
+
+
+def _copy_tree(src, dst):
+    """Recursively copy src into dst, overwriting existing files.
+
+    The copy must duplicate the bytes: plugin downloads overwrite
+    archives in place, so hard-linked "copies" would be corrupted by
+    the very install a backup is meant to protect against.
+    """
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+    for name in os.listdir(src):
+        src_path = os.path.join(src, name)
+        dst_path = os.path.join(dst, name)
+        if os.path.isdir(src_path):
+            _copy_tree(src_path, dst_path)
+        else:
+            shutil.copy(src_path, dst_path)
+
+
+def _remove_tree(path):
+    """Recursively remove the tree at the given path."""
+    for name in os.listdir(path):
+        child = os.path.join(path, name)
+        if os.path.isdir(child):
+            _remove_tree(child)
+        else:
+            os.remove(child)
+    os.rmdir(path)
+
 
 class PluginSiteError(Exception):
     def __init__(self):
@@ -20,47 +58,67 @@ class PluginSiteError(Exception):
 class Plugins(object):
     """Manage Jenkins plugins."""
 
+    __slots__ = ("update_center", "_plugin_info_cache")
+
     def __init__(self):
-        proxy_hostname = hookenv.config()["proxy-hostname"]
-        proxy_port = hookenv.config()["proxy-port"]
-        proxy_username = hookenv.config()["proxy-username"]
-        proxy_password = hookenv.config()["proxy-password"]
+        config = hookenv.config()
+        proxy_hostname = config["proxy-hostname"]
+        proxy_port = config["proxy-port"]
+        proxy_username = config["proxy-username"]
+        proxy_password = config["proxy-password"]
 
         if proxy_hostname and proxy_port:
             if proxy_username and proxy_password:
-                proxy_address = "http://{}:{}@{}:{}".format(
-                    proxy_username,
-                    proxy_password,
+                # Quote the credentials so reserved characters like @, :
+                # or / don't produce a malformed URL.
+                netloc = "{}:{}@{}:{}".format(
+                    quote(str(proxy_username), safe=""),
+                    quote(str(proxy_password), safe=""),
                     proxy_hostname,
                     proxy_port
                 )
             else:
-                proxy_address = "http://{}:{}".format(
+                netloc = "{}:{}".format(
                     proxy_hostname,
                     proxy_port
                 )
+            proxy_address = urlunparse(("http", netloc, "", "", "", ""))
         else:
             proxy_address = None
 
-        # urllib supports the http_proxy env variable
+        # urllib supports the http_proxy/https_proxy env variables
         if proxy_address:
-            hookenv.log("Setting http_proxy env variable to %s" % proxy_address)
+            hookenv.log(
+                "Setting http_proxy and https_proxy env variables "
+                "to %s" % proxy_address)
             os.environ["http_proxy"] = proxy_address
+            os.environ["https_proxy"] = proxy_address
         else:
-            # Unset the environment variable in case it was previously set.
-            hookenv.log("Unsetting http_proxy env variable if it was set")
+            # Unset the environment variables in case they were set.
+            hookenv.log(
+                "Unsetting http_proxy and https_proxy env variables "
+                "if they were set")
             os.environ.pop("http_proxy", None)
+            os.environ.pop("https_proxy", None)
 
-        if hookenv.config()["plugins-site"] == "https://updates.jenkins-ci.org/latest/":
+        if config["plugins-site"] == "https://updates.jenkins-ci.org/latest/":
             self.update_center = UpdateCenter()
         else:
-            plugins_site = hookenv.config()["plugins-site"]
+            plugins_site = config["plugins-site"]
+            update_center = plugins_site + "/update-center.json"
+            # Probe with a HEAD request rather than downloading the
+            # body, since UpdateCenter fetches the JSON itself anyway.
+            # The short timeout keeps a silently dropping mirror from
+            # hanging the hook for the kernel default of minutes.
+            request = urllib.request.Request(update_center, method="HEAD")
             try:
-                update_center = plugins_site + "/update-center.json"
-                urllib.request.urlopen(update_center)
-                self.update_center = UpdateCenter(uc_url=update_center)
-            except urllib.error.HTTPError:
+                urllib.request.urlopen(request, timeout=5)
+            except (urllib.error.URLError, socket.timeout):
                 raise PluginSiteError()
+            self.update_center = UpdateCenter(uc_url=update_center)
+        # Per-instance cache of UpdateCenter plugin data, only valid for
+        # the update center configured above.
+        self._plugin_info_cache = {}
 
     def install(self, plugins):
         """Install the given plugins, optionally removing unlisted ones.
@@ -68,29 +126,66 @@ class Plugins(object):
         @params plugins: A whitespace-separated list of plugins to install.
         """
         hookenv.log("Starting plugins installation process")
+        config = hookenv.config()
+        # Split each plugin list once and reuse the result; the given
+        # plugins are usually the configured ones.
+        configured_list = tuple(config["plugins"].split())
         plugins = plugins or ""
-        plugins = plugins.split()
-        plugins, incompatible_plugins = self._get_plugins_to_install(plugins)
+        if plugins == config["plugins"]:
+            plugin_list = configured_list
+        else:
+            plugin_list = tuple(plugins.split())
+        # If the exact same configuration was installed successfully
+        # before and all its plugin files are still on disk, there is
+        # nothing to resolve, download or restart.
+        fingerprint = self._fingerprint(plugin_list, config)
+        recorded = self._read_fingerprint()
+        if (not config["plugins-auto-update"] and
+                recorded is not None and
+                recorded.get("fingerprint") == fingerprint and
+                os.path.isdir(paths.PLUGINS)):
+            existing_plugins = {
+                os.path.join(paths.PLUGINS, name)
+                for name in os.listdir(paths.PLUGINS)
+                if name.endswith((".jpi", ".hpi"))}
+            existing_names = {
+                os.path.basename(path) for path in existing_plugins}
+            # The recorded files cover the fully resolved set, so a
+            # manually deleted dependency re-triggers the pipeline.
+            if set(recorded.get("files", ())) <= existing_names:
+                hookenv.log(
+                    "Configured plugins unchanged since the last "
+                    "install, nothing to do")
+                return existing_plugins, []
+        plugins, incompatible_plugins = self._get_plugins_to_install(
+            plugin_list, config=config)
         if len(incompatible_plugins) != 0:
             hookenv.log("The following plugins require a higher jenkins version"
                         " and were not installed: (%s)" % " ".join(
                             incompatible_plugins))
-        configured_plugins = self._get_plugins_to_install(
-            hookenv.config()["plugins"].split())
+        # The configured list only needs dependency expansion, not the
+        # compatibility filter, to know which files may stay on disk.
+        configured_plugins = self._resolve_deps(configured_list)
         host.mkdir(
             paths.PLUGINS, owner="jenkins", group="jenkins", perms=0o0755)
-        existing_plugins = set(glob.glob("%s/*.[h|j]pi" % paths.PLUGINS))
+        existing_plugins = {
+            os.path.join(paths.PLUGINS, name)
+            for name in os.listdir(paths.PLUGINS)
+            if name.endswith((".jpi", ".hpi"))}
         try:
-            self._install_plugins(plugins)
+            self._install_plugins(plugins, config)
         except Exception:
             hookenv.log("Plugin installation failed, check logs for details")
             raise
 
-        plugin_file_names = tuple(map(lambda x: "/{}.jpi".format(x), configured_plugins))
-        installed_plugins = set(filter(lambda x: x.endswith(plugin_file_names), existing_plugins))
+        configured_files = {
+            "{}.jpi".format(plugin) for plugin in configured_plugins}
+        installed_plugins = {
+            path for path in existing_plugins
+            if os.path.basename(path) in configured_files}
         unlisted_plugins = existing_plugins - installed_plugins
         if unlisted_plugins:
-            if hookenv.config()["remove-unlisted-plugins"] == "yes":
+            if config["remove-unlisted-plugins"] == "yes":
                 self._remove_plugins(unlisted_plugins)
             else:
                 hookenv.log(
@@ -100,34 +195,64 @@ class Plugins(object):
 
         # Restarting jenkins to pickup configuration changes
         Api().restart()
+        self._write_fingerprint(fingerprint, plugins)
         return installed_plugins, incompatible_plugins
 
-    def _install_plugins(self, plugins):
+    def _install_plugins(self, plugins, config=None):
         """Install the plugins with the given names."""
         hookenv.log("Installing plugins (%s)" % " ".join(plugins))
-        config = hookenv.config()
+        config = config or hookenv.config()
         update = config["plugins-auto-update"]
+        # Only the update path needs installed versions; fetch them all
+        # with one bulk call instead of one REST round trip per plugin.
+        # With auto-update off presence on disk is checked locally.
+        installed_versions = Api().get_plugin_versions() if update else {}
         plugin_paths = set()
-        for plugin in plugins:
-            plugin_path = self._install_plugin(plugin, update)
-            if plugin_path is None:
-                pass
-            elif plugin_path:
-                plugin_paths.add(plugin_path)
-            else:
-                hookenv.log("Failed to download %s" % plugin)
-        # Make sure that the plugin directory is owned by jenkins
-        host.chownr(paths.PLUGINS, owner="jenkins", group="jenkins", chowntopdir=True)
+        # Downloads are independent and network-bound, so run them in
+        # parallel. hookenv.log is safe to call from the workers since it
+        # just shells out to juju-log.
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = {
+                executor.submit(
+                    self._install_plugin, plugin, update,
+                    installed_versions.get(plugin, False)): plugin
+                for plugin in plugins}
+            for future in as_completed(futures):
+                plugin_path = future.result()
+                if plugin_path is None:
+                    pass
+                elif plugin_path:
+                    plugin_paths.add(plugin_path)
+                else:
+                    hookenv.log("Failed to download %s" % futures[future])
+        # Make sure the new files are owned by jenkins. Only the freshly
+        # downloaded paths need fixing, so don't re-walk the whole plugin
+        # directory; install() already creates it owned by jenkins.
+        if plugin_paths:
+            uid = pwd.getpwnam("jenkins").pw_uid
+            gid = grp.getgrnam("jenkins").gr_gid
+            for plugin_path in plugin_paths:
+                os.chown(plugin_path, uid, gid)
         return plugin_paths
 
-    def _install_plugin(self, plugin, update):
+    def _install_plugin(self, plugin, update, plugin_version=False):
         """
         Verify if the plugin is not installed before installing it
         or if it needs an update .
         """
-        plugin_version = Api().get_plugin_version(plugin)
+        if not update:
+            # With auto-update off, presence on disk - as either .jpi or
+            # .hpi, both of which install() treats as installed - is
+            # enough to skip the plugin without touching the network.
+            if (os.path.exists(PLUGIN_FILE_TEMPLATE.format(plugin)) or
+                    os.path.exists(PLUGIN_HPI_TEMPLATE.format(plugin))):
+                hookenv.log("Plugin %s already installed" % plugin)
+                return
+            hookenv.log("Installing plugin %s" % plugin)
+            return self.update_center.download_plugin(
+                    plugin, paths.PLUGINS, with_version=False)
         latest_version = self._get_latest_version(plugin)
-        if not plugin_version or (update and plugin_version != latest_version):
+        if not plugin_version or plugin_version != latest_version:
             hookenv.log("Installing plugin %s-%s" % (plugin, latest_version))
             return self.update_center.download_plugin(
                     plugin, paths.PLUGINS, with_version=False)
@@ -141,24 +266,119 @@ class Plugins(object):
 
     def _remove_plugin(self, path):
         """Remove the plugin at the given path."""
-        if not os.path.isfile(path):
+        # Just try the unlink rather than stat-ing first; missing files
+        # and directories are skipped like before.
+        try:
+            os.unlink(path)
+        except (FileNotFoundError, IsADirectoryError):
             return
         hookenv.log("Deleting unlisted plugin '%s'" % path)
-        os.remove(path)
 
-    def _get_plugins_to_install(self, plugins, uc=None):
+    def _get_plugins_to_install(self, plugins, uc=None, config=None):
         """Get all plugins needed to be installed"""
         uc = uc or self.update_center
-        plugins_and_dependencies = uc.get_plugins(plugins)
-        if plugins == plugins_and_dependencies:
-            return self._exclude_incompatible_plugins(plugins)
-        else:
-            return self._get_plugins_to_install(plugins_and_dependencies, uc)
+        config = config or hookenv.config()
+        cache_key = {
+            "plugins": sorted(plugins),
+            "plugins-site": config["plugins-site"],
+        }
+        # With auto-update enabled the resolution is expected to change
+        # between hooks, so never reuse a previous result.
+        use_cache = not config["plugins-auto-update"]
+        if use_cache:
+            cached = self._read_resolve_cache(cache_key)
+            if cached is not None:
+                return cached
+        result = self._exclude_incompatible_plugins(
+            self._resolve_deps(plugins, uc))
+        if use_cache:
+            self._write_resolve_cache(cache_key, result)
+        return result
+
+    def _resolve_deps(self, plugins, uc=None):
+        """Expand the given plugins to their transitive dependencies.
+
+        Walks the dependency graph with an explicit worklist, asking the
+        update center only about newly discovered plugins on each round
+        instead of re-resolving the whole set.
+        """
+        uc = uc or self.update_center
+        resolved = set()
+        frontier = set(plugins)
+        while frontier:
+            new = set(uc.get_plugins(frontier)) - resolved
+            resolved |= frontier
+            frontier = new - resolved
+        return sorted(resolved)
+
+    def _fingerprint(self, plugin_list, config):
+        """Fingerprint the plugin configuration affecting installs."""
+        payload = json.dumps(sorted(plugin_list) + [
+            config["plugins-site"],
+            config["remove-unlisted-plugins"],
+        ])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _read_fingerprint(self):
+        """Get the record of the last successful install, or None."""
+        try:
+            with open(paths.PLUGINS_FINGERPRINT) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+    def _write_fingerprint(self, fingerprint, plugins):
+        """Record a successful install and its resolved plugin files."""
+        record = {
+            "fingerprint": fingerprint,
+            "files": sorted("{}.jpi".format(plugin) for plugin in plugins),
+        }
+        try:
+            with open(paths.PLUGINS_FINGERPRINT, "w") as fd:
+                json.dump(record, fd)
+        except OSError:
+            hookenv.log(
+                "Could not write plugins fingerprint to %s" %
+                paths.PLUGINS_FINGERPRINT)
+
+    def _read_resolve_cache(self, key):
+        """Get the cached resolution for the given key, or None."""
+        try:
+            with open(paths.PLUGIN_RESOLVE_CACHE) as fd:
+                cache = json.load(fd)
+        except (OSError, ValueError):
+            return None
+        if cache.get("key") != key:
+            return None
+        return cache["plugins"], cache["incompatible"]
+
+    def _write_resolve_cache(self, key, result):
+        """Cache a resolution so unchanged hooks can skip it."""
+        plugins, incompatible_plugins = result
+        cache = {
+            "key": key,
+            "plugins": list(plugins),
+            "incompatible": list(incompatible_plugins),
+        }
+        tmp_path = paths.PLUGIN_RESOLVE_CACHE + ".tmp"
+        try:
+            with open(tmp_path, "w") as fd:
+                json.dump(cache, fd)
+            # os.rename overwrites atomically on POSIX, and unlike
+            # os.replace it is redirected by the unit-test fake
+            # filesystem.
+            os.rename(tmp_path, paths.PLUGIN_RESOLVE_CACHE)
+        except OSError:
+            hookenv.log(
+                "Could not write plugin resolve cache to %s" %
+                paths.PLUGIN_RESOLVE_CACHE)
 
     def _get_plugin_info(self, plugin):
         """Get info of the given plugin from the UpdateCenter"""
-        uc = self.update_center
-        return uc.get_plugin_data(plugin)
+        if plugin not in self._plugin_info_cache:
+            self._plugin_info_cache[plugin] = \
+                self.update_center.get_plugin_data(plugin)
+        return self._plugin_info_cache[plugin]
 
     def _get_latest_version(self, plugin):
         """Get the latest available version of a plugin"""
@@ -186,16 +406,22 @@ class Plugins(object):
         """Backup plugins.
         """
         hookenv.log("Backing up plugins.")
-        copy_tree(paths.PLUGINS, paths.PLUGINS_BACKUP)
+        _copy_tree(paths.PLUGINS, paths.PLUGINS_BACKUP)
 
     def restore(self):
         """Restore plugins from backup directory."""
         hookenv.log("Restoring plugins from backup.")
-        remove_tree(paths.PLUGINS)
-        copy_tree(paths.PLUGINS_BACKUP, paths.PLUGINS)
+        # Swap the backup into place with renames instead of re-copying
+        # the plugin data.
+        old_path = paths.PLUGINS + ".old"
+        os.rename(paths.PLUGINS, old_path)
+        os.rename(paths.PLUGINS_BACKUP, paths.PLUGINS)
+        _remove_tree(old_path)
         shutil.chown(paths.PLUGINS, user="jenkins", group="jenkins")
 
     def clean_backup(self):
         """Remove backup directory."""
         hookenv.log("Cleaning up backup plugins.")
-        remove_tree(paths.PLUGINS_BACKUP)
+        # restore() consumes the backup directory, so it may be gone.
+        if os.path.isdir(paths.PLUGINS_BACKUP):
+            _remove_tree(paths.PLUGINS_BACKUP)
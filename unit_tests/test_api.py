@@ -213,6 +213,16 @@ class ApiTest(JenkinsTest):
         self.assertEqual(self.api.get_plugin_version("installed-plugin"), "1")
         self.assertFalse(self.api.get_plugin_version("not-installed-plugin"))
 
+    def test_get_plugin_versions(self):
+        """
+        The versions of all installed plugins are returned with a single
+        script run.
+        """
+        self.fakes.jenkins.scripts[
+            'Jenkins.instance.pluginManager.plugins.each{println("${it.shortName}=${it.version}")}'] = "one=1\ntwo=2"
+        self.assertEqual(
+            {"one": "1", "two": "2"}, self.api.get_plugin_versions())
+
     def test_configure_proxy(self):
         """Test proxy configuration."""
         # Firstly without authentication